@@ -0,0 +1,690 @@
+"""
+ASGI serving mode.
+
+/process-text, /process-audio and /confirm-send run as coroutines: intent
+extraction and polishing use AsyncOpenAI, Whisper and the Gmail / Calendar
+REST APIs are called with httpx, so a request waiting on the network holds no
+thread and one process can keep hundreds of commands in flight. CPU or
+subprocess work (VAD, ffmpeg, the local STT backend, token refresh) runs on a
+bounded thread pool. Every other route (OAuth, /stats, streaming upload, the
+UI) is served by the Flask app in server.py, which stays the compatibility
+mode under gunicorn.
+
+    uvicorn asgi:app --app-dir app --host 0.0.0.0 --port $PORT --workers 2
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+
+import httpx
+from openai import AsyncOpenAI
+from werkzeug.formparser import parse_form_data
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_cookie
+
+import server
+from server import CommandRequest, CommandResult
+
+ASGI_BLOCKING_WORKERS = int(os.environ.get("ASGI_BLOCKING_WORKERS", "32"))
+ASGI_HTTP_POOL_SIZE = int(os.environ.get("ASGI_HTTP_POOL_SIZE", "100"))
+ASGI_MAX_BODY_BYTES = server.AUDIO_MAX_UPLOAD_BYTES + 1024 * 1024
+
+GMAIL_API = (server.GOOGLE_API_BASE_URL or "https://gmail.googleapis.com") + "/gmail/v1/users/me"
+CALENDAR_API = (server.GOOGLE_API_BASE_URL or "https://www.googleapis.com") + "/calendar/v3/calendars/primary"
+
+_blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix="asgi-blocking")
+
+
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_blocking_executor, fn, *args)
+
+
+# ---------- Async clients ----------
+class GoogleApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Google API error {status}: {message}")
+        self.status = status
+
+
+class AsyncGoogleClient:
+    """The handful of Gmail / Calendar REST calls the command pipeline makes."""
+
+    def __init__(self, http):
+        self.http = http
+
+    async def _call(self, stage, creds, method, url, body=None):
+        with server.timed_stage(stage):
+            resp = await self.http.request(method, url, json=body, headers={"Authorization": f"Bearer {creds.token}"})
+        if resp.status_code >= 400:
+            try:
+                message = resp.json().get("error", {}).get("message")
+            except Exception:
+                message = resp.text
+            raise GoogleApiError(resp.status_code, message)
+        return resp.json()
+
+    async def create_draft(self, creds, message):
+        return await self._call("gmail_draft_create", creds, "POST", f"{GMAIL_API}/drafts", {"message": message})
+
+    async def get_draft_metadata(self, creds, draft_id):
+        return await self._call("gmail_draft_get", creds, "GET", f"{GMAIL_API}/drafts/{quote(draft_id, safe='')}?format=metadata&metadataHeaders=To&metadataHeaders=Subject")
+
+    async def send_draft(self, creds, draft_id):
+        return await self._call("gmail_draft_send", creds, "POST", f"{GMAIL_API}/drafts/send", {"id": draft_id})
+
+    async def insert_event(self, creds, event):
+        return await self._call("calendar_insert", creds, "POST", f"{CALENDAR_API}/events", event)
+
+
+class AsyncTranscriptionClient:
+    """Async twin of server.TranscriptionClient; counts into the same /stats counters."""
+
+    def __init__(self, http, url, max_retries, counters):
+        self.http = http
+        self.url = url
+        self.max_retries = max_retries
+        self.counters = counters
+
+    async def transcribe(self, filename, data, api_key, model="whisper-1"):
+        headers = {"Authorization": f"Bearer {api_key}"}
+        timeout = httpx.Timeout(server.WHISPER_READ_TIMEOUT, connect=server.WHISPER_CONNECT_TIMEOUT)
+        for attempt in range(self.max_retries + 1):
+            self.counters.count("requests")
+            try:
+                resp = await self.http.post(
+                    self.url, headers=headers, data={"model": model}, files={"file": (filename, data)}, timeout=timeout,
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                self.counters.count("network_errors")
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.counters.backoff_delay(attempt)
+                print(f"[whisper] network error ({e}); retrying in {delay:.2f}s")
+            except httpx.TransportError:
+                # read timeouts and the like: the upload may have been billed, so it is not repeated
+                self.counters.count("network_errors")
+                raise
+            else:
+                self.counters.count(None, resp.status_code)
+                if resp.status_code not in server.WHISPER_RETRY_STATUSES or attempt >= self.max_retries:
+                    return resp
+                delay = self.counters.backoff_delay(attempt, resp.headers.get("Retry-After"))
+                print(f"[whisper] status {resp.status_code}; retrying in {delay:.2f}s")
+            self.counters.count("retries")
+            server.FALLBACKS.inc(kind="whisper_retry")
+            await asyncio.sleep(delay)
+
+
+class _Clients:
+    # Created per event loop (uvicorn workers each run their own).
+    def __init__(self):
+        self.loop = None
+
+    def ensure(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return self
+        self.loop = loop
+        limits = httpx.Limits(max_connections=ASGI_HTTP_POOL_SIZE, max_keepalive_connections=ASGI_HTTP_POOL_SIZE)
+        self.http = httpx.AsyncClient(limits=limits, timeout=server.GOOGLE_HTTP_TIMEOUT)
+        self.openai = AsyncOpenAI()
+        self.llm = self.openai.with_options(timeout=server.LLM_MODEL_TIMEOUT, max_retries=0)
+        self.google = AsyncGoogleClient(self.http)
+        self.whisper = AsyncTranscriptionClient(self.http, server.WHISPER_URL, server.WHISPER_MAX_RETRIES, server.whisper_client)
+        return self
+
+    async def close(self):
+        if self.loop is not None:
+            await self.http.aclose()
+            await self.openai.close()
+            self.loop = None
+
+
+clients = _Clients()
+
+
+# ---------- Async command pipeline ----------
+async def hedged_completion_async(models, request_fn, validate_fn, hedge_after=None):
+    """
+    Same contract as server.hedged_completion(), with request_fn(model) returning
+    a coroutine. Unlike the threaded version the losing request is cancelled.
+    Hedges share server.LLM_MAX_HEDGES with the threaded pipeline; a task
+    starts running as soon as it is created, so the hedge timer runs from launch.
+    """
+    hedge_after = server.LLM_HEDGE_AFTER if hedge_after is None else hedge_after
+    started = time.monotonic()
+    pending = {}
+    next_index = 0
+    last_launch = started
+    last_exception = None
+    hedged = hedge_blocked = False
+
+    def _launch(hedge=False):
+        nonlocal next_index, last_launch
+        model = models[next_index]
+        next_index += 1
+        last_launch = time.monotonic()
+        task = asyncio.ensure_future(request_fn(model))
+        if hedge:
+            task.add_done_callback(server._release_hedge)
+        pending[task] = model
+
+    _launch()
+    try:
+        while pending:
+            can_hedge = next_index < len(models) and not hedge_blocked
+            if can_hedge:
+                timeout = max(0.0, hedge_after - (time.monotonic() - last_launch))
+            else:
+                timeout = max(0.0, last_launch + server.LLM_MODEL_TIMEOUT + 1.0 - time.monotonic())
+            done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if can_hedge:
+                    if server._reserve_hedge():
+                        print(f"[llm-hedge] {pending[next(iter(pending))]} slower than {hedge_after}s; hedging to {models[next_index]}")
+                        hedged = True
+                        _launch(hedge=True)
+                    else:
+                        # too many hedges in flight: wait for the calls already made
+                        hedge_blocked = True
+                    continue
+                break
+            for task in done:
+                model = pending.pop(task)
+                try:
+                    value = validate_fn(task.result())
+                except Exception as e:
+                    print(f"[llm-hedge] model {model} gave no usable answer:", e)
+                    last_exception = e
+                    continue
+                server._record_hedge_outcome(model, time.monotonic() - started, hedged)
+                return model, value, None
+            if not pending and next_index < len(models):
+                _launch()
+                hedge_blocked = False
+    finally:
+        for task in pending:
+            task.cancel()
+
+    server._record_hedge_outcome(None, None, hedged)
+    return None, None, last_exception
+
+
+async def parse_intent_async(command_text, include_polished=False):
+    if not os.environ.get("OPENAI_API_KEY"):
+        print("OpenAI API key not set (OPENAI_API_KEY).")
+        return server._unknown_intent("OpenAI API key not configured.")
+    llm = clients.ensure().llm
+    raw_outputs = []
+
+    async def _request(model_name):
+        kwargs = server.intent_completion_kwargs(model_name, command_text, include_polished)
+        out, problem = server.intent_reply(await llm.chat.completions.create(**kwargs))
+        raw_outputs.append(out)
+        parsed, problem, repaired = (None, problem, False) if problem else server.parse_intent_output(out)
+        result = "repaired_local" if repaired else "ok"
+        for _attempt in range(server.LLM_INTENT_REPAIR_ATTEMPTS):
+            if parsed is not None:
+                break
+            print(f"[intent] {model_name} reply unusable ({problem}); asking it to repair")
+            resp = await llm.chat.completions.create(**server.intent_repair_kwargs(kwargs, out, problem))
+            out, problem = server.intent_reply(resp, "intent_repair")
+            raw_outputs.append(out)
+            parsed, problem, _repaired = (None, problem, False) if problem else server.parse_intent_output(out)
+            result = "repaired_llm"
+        server.INTENT_PARSE.inc(result=result if parsed is not None else "failed")
+        if parsed is None:
+            raise ValueError(problem)
+        return parsed
+
+    with server.timed_stage("intent_llm") as fields:
+        model_name, parsed, last_exception = await hedged_completion_async(server.LLM_INTENT_MODELS, _request, lambda parsed: parsed)
+        fields["model"] = model_name
+    if parsed is not None:
+        return parsed
+    return server.intent_failure(raw_outputs, last_exception)
+
+
+async def polish_email_body_async(body):
+    if not server.should_polish(body):
+        return body or ''
+    try:
+        with server.timed_stage("polish_llm", streamed=False):
+            polish_resp = await clients.ensure().openai.chat.completions.create(**server.polish_completion_kwargs(body))
+        server.record_llm_usage("polish", polish_resp)
+        return polish_resp.choices[0].message.content.strip()
+    except Exception as e:
+        print("Polish error:", e)
+        server.FALLBACKS.inc(kind="polish_failed")
+        return body or ''
+
+
+async def resolve_command_async(req):
+    text = req.text or ''
+    cache_tz, cache_key = server.command_cache_context(req)
+    parsed, intent_source = server.lookup_intent_locally(text, cache_key, cache_tz, req.user_id)
+    if parsed is None:
+        parsed = await parse_intent_async(text, include_polished=(server.POLISH_MODE == "fused"))
+    fused_polished = parsed.pop('polished_body', None)
+    server.INTENT_SOURCES.inc(source=intent_source)
+
+    polish_task = None
+    if server.wants_speculative_polish(parsed, fused_polished):
+        polish_task = asyncio.ensure_future(polish_email_body_async(parsed['body']))
+
+    prepared, early = server.finish_resolution(req, parsed, intent_source, cache_key, cache_tz, fused_polished)
+    if early is not None:
+        if polish_task is not None:
+            polish_task.cancel()
+        return None, early
+    prepared.polish_future = polish_task
+    return prepared, None
+
+
+async def execute_command_async(prepared, creds):
+    parsed = prepared.parsed
+    google = clients.ensure().google
+    try:
+        if parsed['intent'] in ['send_email','draft_email']:
+            if prepared.polish_future is not None:
+                polished = await prepared.polish_future
+            elif server.POLISH_MODE == "fused":
+                polished = server.fused_or_plain_body(prepared)
+            else:
+                polished = await polish_email_body_async(parsed.get('body'))
+            message = server.build_gmail_message(parsed.get('recipients') or [], parsed.get('subject') or 'No subject', polished)
+            try:
+                draft = await google.create_draft(creds, message)
+            except Exception as e:
+                print("Draft creation error:", e)
+                return CommandResult({"status":"error","message": str(e)}, 500)
+            return server.draft_result(polished, draft, prepared)
+
+        elif parsed['intent'] in ['create_event','modify_event']:
+            start = parsed.get('start_datetime')
+            end = server.default_event_end(start, parsed.get('end_datetime'))
+            event = server.build_calendar_event(start, end, parsed.get('title') or 'Meeting', parsed.get('recipients'),
+                                                tz_name=parsed.get('timezone'))
+            conflicts = await run_blocking(server.event_conflicts, prepared, creds)
+            created = await google.insert_event(creds, event)
+            server.note_created_event(prepared, created)
+            server.remember_contacts(prepared)
+            return server.event_result(created, conflicts, prepared.contact_names)
+
+        elif parsed['intent'] == 'query_agenda':
+            return await run_blocking(server.agenda_result, prepared, creds)
+
+        else:
+            return CommandResult({"status":"unknown","message":"Sorry, I couldn't understand the command."})
+
+    except Exception as e:
+        print("Error in execute_command_async():", e)
+        return CommandResult({"status":"error","message":str(e)}, 500)
+
+
+async def run_command_async(req):
+    return server.record_outcome("command", await _run_command_async(req))
+
+
+async def _run_command_async(req):
+    prepared, early = await resolve_command_async(req)
+    if early is not None:
+        return early
+    creds = await run_blocking(server.get_google_credentials, req.user_id)
+    if not creds:
+        if prepared.polish_future is not None:
+            prepared.polish_future.cancel()
+        return server._auth_required_result()
+    return await execute_command_async(prepared, creds)
+
+
+def _thread_future(task):
+    """Mirrors an asyncio task into a concurrent Future a job thread can block on."""
+    future = Future()
+
+    def _done(t):
+        if t.cancelled():
+            future.cancel()
+        elif t.exception() is not None:
+            future.set_exception(t.exception())
+        else:
+            future.set_result(t.result())
+
+    task.add_done_callback(_done)
+    return future
+
+
+async def submit_command_async(req, idempotency_key=None):
+    """Resolves the command here and hands the Google call to server.job_queue."""
+    return server.record_outcome("command", await _submit_command_async(req, idempotency_key))
+
+
+async def _submit_command_async(req, idempotency_key=None):
+    prepared, early = await resolve_command_async(req)
+    if early is not None:
+        return early
+    if not await run_blocking(server.get_google_credentials, req.user_id):
+        if prepared.polish_future is not None:
+            prepared.polish_future.cancel()
+        return server._auth_required_result()
+    if prepared.polish_future is not None:
+        prepared.polish_future = _thread_future(prepared.polish_future)
+    return await run_blocking(server.enqueue_command, prepared, idempotency_key)
+
+
+async def transcribe_audio_async(data, api_key, converted=None):
+    upload, error = await run_blocking(server.prepare_whisper_upload, data, converted)
+    if error:
+        return None, error
+    payload, filename, transcoded = upload
+    whisper = clients.ensure().whisper
+
+    try:
+        with server.timed_stage("whisper", filename=filename):
+            resp = await whisper.transcribe(filename, payload, api_key)
+    except Exception as e:
+        print("[process-audio] Network error calling Whisper:", e)
+        return None, ({"status":"error","message":"Network error during transcription","detail": str(e)}, 500)
+
+    retry, transcript, error = server.whisper_first_outcome(resp, transcoded, converted)
+    if not retry:
+        return transcript, error
+
+    server.FALLBACKS.inc(kind="whisper_reconvert")
+    upload, error = await run_blocking(server.prepare_retry_upload, data, converted)
+    if error:
+        return None, error
+    try:
+        with server.timed_stage("whisper", filename=upload[1]):
+            resp_retry = await whisper.transcribe(upload[1], upload[0], api_key)
+    except Exception as e:
+        print("[process-audio] Network error calling Whisper (retry):", e)
+        return None, ({"status":"error","message":"Network error during transcription (retry)","detail": str(e)}, 500)
+    return server.whisper_retry_outcome(resp_retry)
+
+
+async def transcribe_upload_async(data, converted=None):
+    trimmed, converted, report, error = await run_blocking(server.vad_gate, data, converted)
+    if error:
+        return None, error, report
+    backend = server.get_stt_backend()
+    if not isinstance(backend, server.RemoteWhisperBackend):
+        transcript, error = await run_blocking(backend.transcribe, trimmed, converted)
+        return transcript, error, report
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        msg = "OpenAI API key not configured (OPENAI_API_KEY missing)"
+        print("[process-audio] ERROR:", msg)
+        return None, ({"status":"error","message": msg}, 500), report
+    transcript, error = await transcribe_audio_async(trimmed, api_key, converted)
+    return transcript, error, report
+
+
+# ---------- HTTP plumbing ----------
+class BodyTooLarge(Exception):
+    pass
+
+
+def _header(scope, name):
+    name = name.lower().encode("latin-1")
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _read_body(receive, limit=ASGI_MAX_BODY_BYTES):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("client disconnected")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send_json(send, payload, status=200, extra_headers=()):
+    body = json.dumps(payload, default=str).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *extra_headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _headers(scope):
+    return Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope.get("headers", [])])
+
+
+def _user_id(scope):
+    cookies = parse_cookie(_header(scope, "Cookie") or "")
+    return server.user_id_from_session_cookie(cookies.get(server.app.config["SESSION_COOKIE_NAME"]))
+
+
+def _json_body(body):
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _parse_multipart(body, content_type):
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "CONTENT_TYPE": content_type or "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    _stream, form, files = parse_form_data(environ)
+    return form, files
+
+
+# ---------- API endpoints ----------
+async def process_text(scope, receive):
+    data = _json_body(await _read_body(receive))
+    client_tz = data.get('client_timezone') or _header(scope, 'X-Client-Timezone') or None
+    req = CommandRequest(text=data.get('text', ''), client_timezone=client_tz, user_id=_user_id(scope))
+    headers = _headers(scope)
+    if server.wants_async(data, headers):
+        result = await submit_command_async(req, headers.get('Idempotency-Key') or data.get('idempotency_key'))
+    else:
+        result = await run_command_async(req)
+    return result.payload, result.status_code
+
+
+async def process_audio(scope, receive):
+    try:
+        body = await _read_body(receive)
+    except BodyTooLarge:
+        return {"status":"error","message":"Audio file too large."}, 413
+    form, files = await run_blocking(_parse_multipart, body, _header(scope, 'Content-Type'))
+    audio_file = files.get('audio')
+    if not audio_file:
+        return {"status":"error","message":"No audio file uploaded."}, 400
+    data = audio_file.read(server.AUDIO_MAX_UPLOAD_BYTES + 1)
+    if len(data) > server.AUDIO_MAX_UPLOAD_BYTES:
+        return {"status":"error","message":"Audio file too large."}, 413
+    print(f"[process-audio] received upload {audio_file.filename!r}, size={len(data)}")
+
+    transcript, error, vad_report = await transcribe_upload_async(data)
+    if error:
+        return error
+    client_tz = form.get('client_timezone') or _header(scope, 'X-Client-Timezone') or None
+    result = await run_command_async(CommandRequest(text=transcript, client_timezone=client_tz, user_id=_user_id(scope)))
+    extra = {"vad": vad_report} if vad_report else {}
+    return {"status":"ok","transcript": transcript, **extra, **result.payload}, result.status_code
+
+
+async def confirm_send(scope, receive):
+    data = _json_body(await _read_body(receive))
+    draft_id = data.get('draft_id')
+    print(f"[confirm_send] Received confirm-send request. draft_id={draft_id}")
+    if not draft_id:
+        return {"status":"error","message":"draft_id required"}, 400
+
+    user_id = _user_id(scope)
+    creds = await run_blocking(server.get_google_credentials, user_id)
+    if not creds:
+        return server.record_outcome("send", server._auth_required_result()).payload, 401
+    verify = server.is_true_flag(data.get('verify', server.CONFIRM_SEND_VERIFY))
+    headers = _headers(scope)
+    if server.wants_async(data, headers):
+        result = await run_blocking(server.enqueue_send, user_id, draft_id,
+                                    headers.get('Idempotency-Key') or data.get('idempotency_key'), verify)
+        return server.record_outcome("send", result).payload, result.status_code
+
+    google = clients.ensure().google
+    info = None
+    try:
+        if verify:
+            info, error = server.verify_cached_draft(draft_id, user_id)
+            if error is not None:
+                return server.record_outcome("send", error).payload, error.status_code
+            if info is None:
+                info = server.draft_info_from_api(await google.get_draft_metadata(creds, draft_id))
+        sent = await google.send_draft(creds, draft_id)
+    except GoogleApiError as e:
+        if e.status != 404:
+            raise
+        result = server.draft_not_found_result()
+        return server.record_outcome("send", result).payload, result.status_code
+    result = server.draft_sent_result(draft_id, user_id, info, sent)
+    return server.record_outcome("send", result).payload, result.status_code
+
+
+ROUTES = {
+    ("POST", "/process-text"): process_text,
+    ("POST", "/process-audio"): process_audio,
+    ("POST", "/confirm-send"): confirm_send,
+}
+
+
+# ---------- Flask compatibility ----------
+def _wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope.get("headers", []):
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _start_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = server.app(environ, start_response)
+    return response["status"], response["headers"], result
+
+
+async def call_flask(scope, receive, send):
+    """
+    Serves one request with the Flask app on the blocking pool. The body is
+    relayed chunk by chunk, so streamed (SSE) responses stay streamed.
+    """
+    try:
+        body = await _read_body(receive)
+    except BodyTooLarge:
+        await _send_json(send, {"status":"error","message":"Request body too large."}, 413)
+        return
+    status, headers, result = await run_blocking(_start_wsgi, _wsgi_environ(scope, body))
+    chunks = iter(result)
+    try:
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+        while True:
+            chunk = await run_blocking(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await run_blocking(result.close)
+
+
+# ---------- ASGI entry point ----------
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            clients.ensure()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await clients.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    if handler is not None and ("text/event-stream" in (_header(scope, "Accept") or "") or b"stream=1" in scope.get("query_string", b"")):
+        handler = None  # progress streaming is implemented once, in the Flask app
+    if handler is None:
+        await call_flask(scope, receive, send)
+        return
+    # each request runs in its own task, so the request id stays with it
+    request_id = _header(scope, "X-Request-ID") or uuid.uuid4().hex
+    server._request_id.set(request_id)
+    endpoint = scope["path"]
+    server.HTTP_IN_FLIGHT.inc(endpoint=endpoint)
+    started = time.perf_counter()
+    try:
+        if _user_id(scope) is None:
+            result = server._auth_required_result()
+            payload, status = result.payload, result.status_code
+        else:
+            payload, status = await handler(scope, receive)
+    except BodyTooLarge:
+        payload, status = {"status":"error","message":"Request body too large."}, 413
+    except Exception as e:
+        print(f"[asgi] {scope['path']} failed:", repr(e))
+        traceback.print_exc()
+        payload, status = {"status":"error","message": str(e)}, 500
+    finally:
+        server.HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+    server.HTTP_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    server.HTTP_REQUESTS.inc(endpoint=endpoint, status=status)
+    await _send_json(send, payload, status, [(b"x-request-id", request_id.encode("latin-1"))])
@@ -0,0 +1,138 @@
+"""
+Times the calendar mirror's overlap queries and snapshot files.
+
+Builds a synthetic calendar (--events events over --days days: working-hour
+meetings of 15 minutes to 3 hours, some all-day and multi-day events, a few
+marked free) and answers the two questions the server asks it:
+
+    conflict  the busy events overlapping a new one-hour event
+    agenda    the events on one day
+
+each with server.EventIndex and with a linear scan over every event, and
+checks that both give the same answer. It then writes the calendar as a
+mirror snapshot and reports its size and the save / load times.
+
+    python bench/calendar_benchmark.py
+    python bench/calendar_benchmark.py --events 20000 --queries 2000 --json calendar.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+os.environ.setdefault("STT_WARMUP", "0")
+# server.py builds an OpenAI client at import time; nothing here calls it
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from stt_benchmark import percentile
+
+DAY = 86400
+
+
+def synthetic_events(server, count, days, seed):
+    rng = random.Random(seed)
+    base = time.time() - days // 2 * DAY
+    events = []
+    for i in range(count):
+        day = base + rng.randrange(days) * DAY
+        kind = rng.random()
+        if kind < 0.03:
+            start = day - day % DAY
+            end = start + DAY * rng.choice((1, 1, 2, 5))
+            all_day = True
+        else:
+            start = day - day % DAY + rng.randrange(7 * 4, 19 * 4) * 900
+            end = start + rng.choice((15, 30, 30, 45, 60, 60, 90, 180)) * 60
+            all_day = False
+        events.append(server.MirrorEvent(start, end, f"evt{i:07d}", f"Event {i}", all_day,
+                                         rng.random() > 0.05, f"https://calendar.example/event?eid=evt{i:07d}"))
+    return events, base
+
+
+def linear(events, start, end):
+    return sorted(e for e in events if e.start < end and (e.end > start or e.start >= start))
+
+
+def time_queries(fn, windows):
+    samples = []
+    for start, end in windows:
+        started = time.perf_counter()
+        fn(start, end)
+        samples.append(time.perf_counter() - started)
+    return {
+        "queries": len(samples),
+        "mean_us": round(statistics.mean(samples) * 1e6, 2),
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 2),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000, help="events in the synthetic calendar")
+    parser.add_argument("--days", type=int, default=400, help="days the events are spread over")
+    parser.add_argument("--queries", type=int, default=1000, help="queries of each kind")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    import server
+
+    events, base = synthetic_events(server, args.events, args.days, args.seed)
+    started = time.perf_counter()
+    index = server.EventIndex(events)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    rng = random.Random(args.seed + 1)
+    kinds = {}
+    for name, length in (("conflict", 3600), ("agenda", DAY)):
+        windows = []
+        for _ in range(args.queries):
+            start = base + rng.randrange(args.days) * DAY + (rng.randrange(8 * 4, 18 * 4) * 900 if length < DAY else 0)
+            windows.append((start, start + length))
+        mismatches = sum(1 for a, b in windows if index.overlapping(a, b) != linear(events, a, b))
+        kinds[name] = {
+            "index": time_queries(index.overlapping, windows),
+            "linear": time_queries(lambda a, b: linear(events, a, b), windows),
+            "mismatches": mismatches,
+        }
+
+    with tempfile.TemporaryDirectory() as directory:
+        mirror = server.CalendarMirror(directory, 1)
+        cal = server.UserCalendar(events={e.id: e for e in events}, index=index, sync_token="bench",
+                                  time_zone="UTC", synced_at=time.time())
+        started = time.perf_counter()
+        mirror._save("bench", cal)
+        save_ms = (time.perf_counter() - started) * 1000
+        size = os.path.getsize(mirror._path("bench"))
+        started = time.perf_counter()
+        loaded = mirror._load("bench")
+        load_ms = (time.perf_counter() - started) * 1000
+    snapshot = {"bytes": size, "bytes_per_event": round(size / max(len(events), 1), 1),
+                "save_ms": round(save_ms, 1), "load_ms": round(load_ms, 1),
+                "round_trip_ok": loaded is not None and sorted(loaded.events.values()) == sorted(events)}
+
+    report = {"events": len(events), "index_build_ms": round(build_ms, 1), "queries": kinds, "snapshot": snapshot}
+    print(f"{len(events)} events, index built in {report['index_build_ms']} ms")
+    print(f"\n{'query':<10}{'index p50 us':>14}{'index p99 us':>14}{'linear p50 us':>15}{'linear p99 us':>15}{'mismatches':>12}")
+    for name, row in kinds.items():
+        print(f"{name:<10}{row['index']['p50_us']:>14}{row['index']['p99_us']:>14}"
+              f"{row['linear']['p50_us']:>15}{row['linear']['p99_us']:>15}{row['mismatches']:>12}")
+    print(f"\nsnapshot: {size} bytes ({snapshot['bytes_per_event']} per event), "
+          f"save {snapshot['save_ms']} ms, load {snapshot['load_ms']} ms, round trip ok: {snapshot['round_trip_ok']}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if any(row["mismatches"] for row in kinds.values()) or not snapshot["round_trip_ok"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Measures how many recipient clarify round trips the contact index saves.
+
+The corpus (default bench/corpus/contacts.json) is a recorded address book
+and the names users actually said:
+
+    "sent":    {address: times drafted to}, replayed through ContactBook.learn
+    "aliases": {spoken alias: address}, added as POST /contacts would
+    "cases":   [{"said": "Pria", "expect": "priya.sharma@example.com"}, ...]
+
+"expect": null means the name must not be guessed: it is unknown or could be
+more than one person, so a clarify question is the right answer. Without the
+index every spoken name costs a clarify round trip (another recording, Whisper
+and LLM call); the report counts how many remain, how many of those only
+confirm a suggested address ("Did you mean ...?", for names that are not an
+exact match), and how many names were filled in or suggested with the wrong
+address. The exit status is 1 on any wrong address.
+
+    python bench/contacts_benchmark.py
+    python bench/contacts_benchmark.py --scale 5000 --repeat 200 --json contacts.json
+
+Lookup latency is measured on the corpus book and on a synthetic book of
+--scale addresses, where the fuzzy walk over the trie does the most work.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+os.environ.setdefault("STT_WARMUP", "0")
+# server.py builds an OpenAI client at import time; nothing here calls it
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from stt_benchmark import percentile
+
+FIRST = ["amara", "bjorn", "chiara", "dmitri", "eszter", "farid", "greta", "hiroshi", "ines", "jakub", "kemal",
+         "leila", "mateo", "noor", "oskar", "pilar", "quentin", "rosa", "soren", "tamsin", "ugo", "vera", "wanjiru",
+         "ximena", "yusuf", "zofia"]
+LAST = ["abara", "bianchi", "castillo", "dubois", "eriksen", "fischer", "garcia", "haddad", "ivanova", "jensen",
+        "kowalski", "lindqvist", "moreau", "nakamura", "okafor", "popescu", "quinn", "rahman", "santos", "takahashi"]
+
+
+def time_lookups(fn, names, repeat):
+    samples = []
+    for _ in range(repeat):
+        for name in names:
+            started = time.perf_counter()
+            fn(name)
+            samples.append(time.perf_counter() - started)
+    return {
+        "lookups": len(samples),
+        "mean_us": round(statistics.mean(samples) * 1e6, 2),
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 2),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 2),
+    }
+
+
+def synthetic_index(server, size, seed):
+    rng = random.Random(seed)
+    index = server.ContactIndex()
+    for i in range(size):
+        address = f"{rng.choice(FIRST)}.{rng.choice(LAST)}{i}@example.com"
+        index.add(address, server.names_from_address(address), rng.randrange(1, 20))
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus", "contacts.json"), help="address book and spoken names")
+    parser.add_argument("--scale", type=int, default=2000, help="addresses in the synthetic book")
+    parser.add_argument("--repeat", type=int, default=100, help="timed passes over the spoken names")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["CONTACTS_DB"] = os.path.join(directory, "contacts.db")
+        import server
+
+        book = server.ContactBook(os.environ["CONTACTS_DB"], 1)
+        started = time.perf_counter()
+        for address, uses in corpus["sent"].items():
+            for _ in range(uses):
+                book.learn("bench", [address])
+        for alias, address in corpus["aliases"].items():
+            book.add_alias("bench", alias, address)
+        learn_ms = (time.perf_counter() - started) * 1000
+        book._indexes.clear()
+        started = time.perf_counter()
+        index = book.index("bench")
+        load_ms = (time.perf_counter() - started) * 1000
+
+        outcomes = {"resolved": 0, "suggested": 0, "clarified": 0, "wrong": 0, "missed": 0}
+        problems = []
+        for case in corpus["cases"]:
+            address, candidates = index.resolve(case["said"])
+            if address is None and len(candidates) == 1:
+                outcomes["clarified"] += 1
+                if candidates[0] == case["expect"]:
+                    outcomes["suggested"] += 1
+                else:
+                    outcomes["wrong"] += 1
+                    problems.append(f"WRONG {case['said']!r}: expected {case['expect']}, suggested {candidates[0]}")
+            elif address is None:
+                outcomes["clarified"] += 1
+                if case["expect"] is not None:
+                    outcomes["missed"] += 1
+                    problems.append(f"MISS {case['said']!r}: expected {case['expect']}, got a clarify (candidates {candidates})")
+            elif address == case["expect"]:
+                outcomes["resolved"] += 1
+            else:
+                outcomes["wrong"] += 1
+                problems.append(f"WRONG {case['said']!r}: expected {case['expect']}, got {address}")
+
+        names = [case["said"] for case in corpus["cases"]]
+        big = synthetic_index(server, args.scale, args.seed)
+        rng = random.Random(args.seed + 1)
+        spoken = [rng.choice(FIRST) for _ in range(20)] + [rng.choice(FIRST)[:-1] + "e" for _ in range(20)] + \
+                 [f"{rng.choice(FIRST)} {rng.choice(LAST)}" for _ in range(20)]
+        latency = {
+            "corpus_book": time_lookups(index.resolve, names, args.repeat),
+            f"synthetic_{args.scale}": time_lookups(big.resolve, spoken, max(1, args.repeat // 10)),
+        }
+
+    cases = len(corpus["cases"])
+    report = {
+        "contacts": len(corpus["sent"]),
+        "aliases": len(corpus["aliases"]),
+        "cases": cases,
+        "clarify_round_trips": {"without_index": cases, "with_index": outcomes["clarified"]},
+        "outcomes": outcomes,
+        "learn_ms": round(learn_ms, 1),
+        "index_load_ms": round(load_ms, 2),
+        "latency": latency,
+        "problems": problems,
+    }
+    for problem in problems:
+        print(problem)
+    print(f"\n{cases} spoken names, {report['contacts']} contacts, {report['aliases']} aliases")
+    print(f"clarify round trips: {cases} without the index, {outcomes['clarified']} with it "
+          f"({outcomes['suggested']} confirm a suggestion, {outcomes['missed']} missed)")
+    print(f"resolved {outcomes['resolved']}, wrong address {outcomes['wrong']}")
+    print(f"index load from sqlite: {report['index_load_ms']} ms")
+    print(f"\n{'book':<20}{'lookups':>10}{'p50 us':>10}{'p99 us':>10}")
+    for name, row in latency.items():
+        print(f"{name:<20}{row['lookups']:>10}{row['p50_us']:>10}{row['p99_us']:>10}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if outcomes["wrong"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Compares the intent prompt layouts by input tokens and time to first token.
+
+"inline" is the layout used before the prompt was split: a one-line system
+message and the instructions, polish rule and command in a single user
+message. "split" is the current layout from server.intent_messages(): the
+instructions are a fixed system prefix that the provider can cache, and the
+command is the only user message. "unpadded" is the split layout without
+the worked COMMAND examples, which are what lifts the prefix past the cache
+threshold.
+
+Without --live the script renders both layouts for every command in the
+corpus and estimates prompt tokens and how many of them a provider cache
+would serve (OpenAI caches a repeated prefix from 1024 tokens, in 128-token
+steps). Tokens are counted with tiktoken when it is installed, otherwise as
+characters / 4.
+
+Cached tokens are billed at a discount (--cached-discount, 0.5 for
+gpt-4o-mini, 0.75 for the gpt-4.1 family), so both reports also give
+billed-equivalent tokens, i.e. uncached + (1 - discount) x cached: "cold" for
+a call that finds nothing cached (the first call, or one after the provider
+evicted the prefix) and "warm" for a call that reuses the prefix. A longer
+cacheable prefix only pays off when enough calls are warm; the report gives
+the share of warm calls above which split bills less than unpadded.
+
+    python bench/prompt_benchmark.py --corpus bench/corpus
+    python bench/prompt_benchmark.py --corpus bench/corpus --live --model gpt-4o-mini --repeat 3
+
+--live sends every command with each layout (streaming) and reports time to
+first token and the prompt / cached token counts from the API's usage block.
+It needs OPENAI_API_KEY and honours OPENAI_BASE_URL.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from replay import load_commands
+from stt_benchmark import percentile
+
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+# The single-message prompt used before the split, kept for comparison.
+LEGACY_INTENT_PROMPT = """
+You are an assistant that extracts intent from a single spoken command related to Gmail or Calendar.
+Return strict JSON only with these fields:
+{
+  "intent": "send_email" | "draft_email" | "create_event" | "modify_event" | "unknown",
+  "recipients": ["email1@domain.com", ...],
+  "subject": "subject text" or null,
+  "body": "email body" or null,
+  "start_datetime": "YYYY-MM-DDTHH:MM:SS" or null,
+  "end_datetime": "YYYY-MM-DDTHH:MM:SS" or null,
+  "title": "meeting title" or null,
+  "timezone": "IANA timezone name like Asia/Kolkata" or null,
+  "clarify": ["question1", ...]
+}
+Rules (IMPORTANT):
+- Provide strict JSON only. Do not add any commentary outside the JSON.
+- For datetimes:
+  - If the user mentions a local time (e.g., "tomorrow at 10 AM") and you can infer the user's timezone, return ISO datetimes in that timezone (e.g. "2025-09-08T10:00:00") and set "timezone" to an IANA name (e.g. "Asia/Kolkata").
+  - If you cannot reliably infer the timezone, return naive ISO datetimes (YYYY-MM-DDTHH:MM:SS without offset) and set "timezone" to null; the backend will assume the server/user local timezone.
+- **Auto-fill sensible defaults (do this instead of asking trivial questions):**
+  - If the user requests creating a meeting but **does not specify a title**, set `"title"` to a reasonable default: prefer `"Meeting with <participant>"` if attendees are known, otherwise `"Meeting"` or `"Meeting - <short excerpt of body>"`.
+  - If the user does not specify an end time, set `"end_datetime"` to be **one hour after** `"start_datetime"`.
+  - If the user does not specify a meeting duration, assume **1 hour** unless explicitly requested otherwise.
+- **When to clarify (only ask when essential):**
+  - Ask clarifying questions only if a *required* piece of information is missing or ambiguous such that you cannot safely act — for example:
+    - Email recipient is missing or ambiguous (e.g., "HR" with no clear mapping) → ask which email address to use.
+    - The time is ambiguous (e.g., "this evening" without a resolvable time) and you cannot infer a concrete start time → ask for a specific hour.
+    - The user explicitly asked to confirm before sending (e.g., "Send this now") — if unsure, ask for confirmation.
+  - **Do not** ask for title or end time when a sensible default can be applied as above.
+- For recipients: return email addresses if available; if the user gives a name (e.g., "HR", "finance team") and you cannot resolve it to an email, set recipients to [] and add a clarifying question asking for the specific email.
+- Keep answers minimal and factual inside the JSON. No extra fields.__EXTRA_RULES__
+Examples:
+User: "Send an email to HR asking for the updated hiring report"
+-> If you cannot map "HR" to an email, set recipients=[] and include clarify like ["Which HR email should I use?"]
+User: "Schedule a meeting tomorrow at 10 AM with the finance team"
+-> Return start_datetime as the inferred ISO for tomorrow at 10:00, timezone as an IANA name if you can infer it, set end_datetime to one hour later, set title to "Meeting with finance team" (or similar), and clarify only if recipients/time are ambiguous.
+Now parse this command:
+---
+COMMAND: \"\"\"__CMD__\"\"\"
+"""
+LEGACY_POLISHED_BODY_RULE = """
+- Exception to the rule above: also include "polished_body": the email body polished for professionalism, keeping length similar (null if there is no body)."""
+
+
+def inline_messages(command_text, include_polished=False):
+    prompt = LEGACY_INTENT_PROMPT.replace("__EXTRA_RULES__", LEGACY_POLISHED_BODY_RULE if include_polished else "")
+    return [
+        {"role": "system", "content": "You are a JSON extractor."},
+        {"role": "user", "content": prompt.replace("__CMD__", command_text)},
+    ]
+
+
+def unpadded_messages(server):
+    instructions = server.INTENT_INSTRUCTIONS
+    instructions = instructions[:instructions.index("\nCOMMAND: ", instructions.index("Examples:"))]
+
+    def build(command_text, include_polished=False):
+        messages = server.intent_messages(command_text, include_polished)
+        messages[0] = dict(messages[0], content=messages[0]["content"].replace(server.INTENT_INSTRUCTIONS, instructions))
+        return messages
+    return build
+
+
+def token_counter():
+    try:
+        import tiktoken
+    except ImportError:
+        return lambda text: (len(text) + 3) // 4, "chars/4"
+    encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text)), "tiktoken o200k_base"
+
+
+def render(messages):
+    # close enough to the chat template for prefix comparisons
+    return "".join(f"<|{m['role']}|>{m['content']}<|end|>" for m in messages)
+
+
+def common_prefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+def cacheable_tokens(prefix_tokens):
+    if prefix_tokens < CACHE_MIN_TOKENS:
+        return 0
+    return prefix_tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS
+
+
+def billed(uncached, cached, discount):
+    return uncached + (1 - discount) * cached
+
+
+def break_even_hit_rate(report):
+    """Share of warm calls above which the split layout bills less than the unpadded one."""
+    unpadded, split = report.get("unpadded"), report.get("split")
+    if not unpadded or not split:
+        return None
+    baseline = unpadded["warm_billed_tokens_mean"]
+    cold, warm = split["cold_billed_tokens_mean"], split["warm_billed_tokens_mean"]
+    if cold <= baseline:
+        return 0.0
+    if warm >= baseline:
+        return None  # never
+    return round((cold - baseline) / (cold - warm), 2)
+
+
+def estimate(layouts, commands, polish, count_tokens, discount):
+    """Prompt tokens per call, the share a warm prefix cache would serve and billed-equivalent tokens, per layout."""
+    report = {}
+    for name, build in layouts.items():
+        prompt, cached, previous = [], [], None
+        for i, command in enumerate(commands):
+            # alternate the fused-polish variant when asked, as a mixed workload would
+            text = render(build(command["text"], polish and i % 2 == 1))
+            prompt.append(count_tokens(text))
+            cached.append(cacheable_tokens(count_tokens(common_prefix(previous, text))) if previous else 0)
+            previous = text
+        warm = cached[1:] or cached
+        report[name] = {
+            "calls": len(prompt),
+            "prompt_tokens_mean": round(statistics.mean(prompt), 1),
+            "cached_tokens_mean": round(statistics.mean(warm), 1),
+            "uncached_tokens_mean": round(statistics.mean(p - c for p, c in zip(prompt[1:] or prompt, warm)), 1),
+            "cold_billed_tokens_mean": round(statistics.mean(prompt), 1),
+            "warm_billed_tokens_mean": round(statistics.mean(billed(p - c, c, discount) for p, c in zip(prompt[1:] or prompt, warm)), 1),
+        }
+    return report
+
+
+def run_live(server, layouts, commands, model, repeat, polish, discount):
+    report = {}
+    for name, build in layouts.items():
+        ttft, prompt, cached, failures = [], [], [], 0
+        for _ in range(repeat):
+            for i, command in enumerate(commands):
+                include_polished = polish and i % 2 == 1
+                kwargs = server.intent_completion_kwargs(model, command["text"], include_polished)
+                kwargs["messages"] = build(command["text"], include_polished)
+                if build is not server.intent_messages:
+                    kwargs.pop("prompt_cache_key", None)
+                started = time.perf_counter()
+                first = usage = None
+                try:
+                    stream = server.openai_client.chat.completions.create(
+                        stream=True, stream_options={"include_usage": True}, **kwargs)
+                    for chunk in stream:
+                        if first is None and chunk.choices and chunk.choices[0].delta.content:
+                            first = time.perf_counter() - started
+                        if chunk.usage is not None:
+                            usage = chunk.usage
+                except Exception as e:
+                    print(f"[{name}] {command['text'][:40]!r} failed: {e}")
+                    failures += 1
+                    continue
+                if first is not None:
+                    ttft.append(first)
+                if usage is not None:
+                    details = getattr(usage, "prompt_tokens_details", None)
+                    prompt.append(usage.prompt_tokens or 0)
+                    cached.append((getattr(details, "cached_tokens", None) or 0) if details is not None else 0)
+        report[name] = {
+            "calls": len(ttft),
+            "failures": failures,
+            "ttft_p50_ms": round(percentile(ttft, 0.50) * 1000, 1) if ttft else None,
+            "ttft_p95_ms": round(percentile(ttft, 0.95) * 1000, 1) if ttft else None,
+            "prompt_tokens_mean": round(statistics.mean(prompt), 1) if prompt else None,
+            "cached_tokens_mean": round(statistics.mean(cached), 1) if cached else None,
+            "uncached_tokens_mean": round(statistics.mean(p - c for p, c in zip(prompt, cached)), 1) if prompt else None,
+            # as measured: the calls the provider served without a cache hit, and those with one
+            "cold_billed_tokens_mean": round(statistics.mean(p for p, c in zip(prompt, cached) if not c), 1)
+            if any(not c for c in cached) else None,
+            "warm_billed_tokens_mean": round(statistics.mean(billed(p - c, c, discount) for p, c in zip(prompt, cached) if c), 1)
+            if any(cached) else None,
+        }
+    return report
+
+
+def print_report(title, report, columns):
+    print(f"\n{title}")
+    widths = [max(22, len(c) + 2) for c in columns]
+    print(f"{'layout':<10}" + "".join(f"{c:>{w}}" for c, w in zip(columns, widths)))
+    for name, row in report.items():
+        print(f"{name:<10}" + "".join(f"{str(row.get(c, '-')):>{w}}" for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", required=True, help="directory with commands.jsonl")
+    parser.add_argument("--polish", action="store_true", help="mix in the fused-polish variant on every other call")
+    parser.add_argument("--live", action="store_true", help="call the API and measure time to first token")
+    parser.add_argument("--model", default="gpt-4o-mini", help="model for --live")
+    parser.add_argument("--repeat", type=int, default=2, help="passes over the corpus for --live (the first warms the cache)")
+    parser.add_argument("--cached-discount", type=float, default=0.5,
+                        help="price reduction for cached input tokens (0.5 for gpt-4o-mini, 0.75 for gpt-4.1)")
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    if not os.environ.get("OPENAI_API_KEY"):
+        if args.live:
+            sys.exit("OPENAI_API_KEY is required for --live")
+        # server.py builds an OpenAI client at import time; the estimate never uses it
+        os.environ["OPENAI_API_KEY"] = "unused"
+    os.environ.setdefault("STT_WARMUP", "0")
+    sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+    import server
+
+    commands = load_commands(args.corpus)
+    if not commands:
+        sys.exit(f"no commands.jsonl in {args.corpus}")
+    layouts = {"inline": inline_messages, "unpadded": unpadded_messages(server), "split": server.intent_messages}
+
+    count_tokens, counted_with = token_counter()
+    billed_columns = ["cold_billed_tokens_mean", "warm_billed_tokens_mean"]
+    report = {"estimate": estimate(layouts, commands, args.polish, count_tokens, args.cached_discount)}
+    report["estimate_break_even_hit_rate"] = break_even_hit_rate(report["estimate"])
+    print_report(f"estimated prompt tokens per call ({counted_with}, warm cache)", report["estimate"],
+                 ["prompt_tokens_mean", "cached_tokens_mean", "uncached_tokens_mean"])
+    print_report(f"estimated billed-equivalent tokens per call (cached discount {args.cached_discount:.0%})",
+                 report["estimate"], billed_columns)
+    print(f"split bills less than unpadded when more than {report['estimate_break_even_hit_rate']} of calls are warm")
+    if args.live:
+        report["live"] = run_live(server, layouts, commands, args.model, args.repeat, args.polish, args.cached_discount)
+        print_report(f"live, {args.model}, {args.repeat} pass(es)", report["live"],
+                     ["ttft_p50_ms", "ttft_p95_ms", "prompt_tokens_mean", "cached_tokens_mean", "uncached_tokens_mean"])
+        print_report(f"live billed-equivalent tokens per call (cached discount {args.cached_discount:.0%})",
+                     report["live"], billed_columns)
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
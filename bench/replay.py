@@ -0,0 +1,274 @@
+"""
+Replays a corpus of commands and audio clips against the server with the
+OpenAI and Google APIs replaced by local stubs (bench/stubs.py), and reports
+p50/p95/p99 latency and throughput per endpoint and per pipeline stage.
+
+The corpus directory holds commands.jsonl (one {"text": ..., "intent": {...}}
+per line; the recorded intent is what the chat stub answers) and audio clips
+with a same-named .txt transcript, as for stt_benchmark.py. The clip_*.wav
+files in bench/corpus are synthetic (voice-like tones, 16 kHz mono): the
+Whisper stub answers them by checksum, so they drive /process-audio, but
+measuring transcription needs recorded clips.
+
+    python bench/replay.py --corpus bench/corpus --concurrency 16 --repeat 20 \
+        --latency chat=450:1400 --latency whisper=900:2500 --latency gmail=150:400 --latency calendar=150:400
+
+By default the server is started for the run (--server flask, gunicorn or
+asgi) in a scratch directory, pre-authorized with a stub Google token, and
+stage timings are read from its structured "stage" log lines. --target URL
+replays against a server that is already running (it must be pointed at the
+stubs, which are then started on --stub-port); only endpoint figures are
+reported in that case.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+sys.path.insert(0, BENCH_DIR)
+
+from stt_benchmark import load_corpus, percentile
+import stubs
+
+STUB_TOKEN = {
+    "token": "stub-access-token", "refresh_token": "stub-refresh-token",
+    "token_uri": "https://oauth2.googleapis.com/token", "client_id": "stub", "client_secret": "stub",
+    "scopes": ["https://www.googleapis.com/auth/gmail.send", "https://www.googleapis.com/auth/calendar.events",
+               "https://www.googleapis.com/auth/gmail.compose"],
+    "expiry": "2099-01-01T00:00:00Z",
+}
+
+
+def load_commands(corpus_dir):
+    path = os.path.join(corpus_dir, "commands.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def server_command(kind, port, workers):
+    if kind == "flask":
+        return [sys.executable, os.path.join(APP_DIR, "server.py")]
+    if kind == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", "8",
+                "-b", f"127.0.0.1:{port}", "server:app"]
+    if kind == "asgi":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--app-dir", APP_DIR,
+                "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    raise ValueError(f"unknown server kind {kind!r}")
+
+
+def start_server(kind, port, workers, stub_url, workdir, extra_env):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "PYTHONPATH": os.path.abspath(APP_DIR) + os.pathsep + env.get("PYTHONPATH", ""),
+        "PYTHONUNBUFFERED": "1",
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "GOOGLE_API_BASE_URL": stub_url,
+        "GOOGLE_TOKEN_JSON": json.dumps(STUB_TOKEN),
+        "SINGLE_TENANT": "1",
+        "FLASK_SECRET_KEY": "replay-benchmark",
+        "METRICS_LOG_STAGES": "1",
+    })
+    env.update(extra_env)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen(server_command(kind, port, workers), cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+
+def wait_until_up(base_url, proc, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            sys.exit(f"server exited with status {proc.returncode}; see its server.log")
+        try:
+            if requests.get(f"{base_url}/stats", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.25)
+    sys.exit(f"server at {base_url} did not come up within {timeout:.0f}s")
+
+
+def build_workload(commands, clips, repeat, seed):
+    work = []
+    for _ in range(repeat):
+        work.extend(("/process-text", {"text": c["text"], "client_timezone": c.get("client_timezone")}) for c in commands)
+        work.extend(("/process-audio", clip) for clip in clips)
+    random.Random(seed).shuffle(work)
+    return work
+
+
+_sessions = threading.local()
+
+
+def send_one(base_url, endpoint, item):
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    started = time.perf_counter()
+    try:
+        if endpoint == "/process-audio":
+            resp = session.post(base_url + endpoint, files={"audio": (item["name"], item["audio"])}, timeout=120)
+        else:
+            resp = session.post(base_url + endpoint, json=item, timeout=120)
+        status = resp.status_code
+        outcome = (resp.json() or {}).get("status") if resp.headers.get("Content-Type", "").startswith("application/json") else None
+    except requests.RequestException as e:
+        status, outcome = None, type(e).__name__
+    return endpoint, status, outcome, time.perf_counter() - started
+
+
+def run_workload(base_url, work, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda w: send_one(base_url, *w), work))
+    return results, time.perf_counter() - started
+
+
+def summarize(samples, wall_seconds=None):
+    out = {"count": len(samples)}
+    if samples:
+        out.update({
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 1),
+        })
+    if wall_seconds:
+        out["req_per_s"] = round(len(samples) / wall_seconds, 2)
+    return out
+
+
+def endpoint_report(results, wall_seconds):
+    report = {}
+    for endpoint in sorted({r[0] for r in results}):
+        rows = [r for r in results if r[0] == endpoint]
+        summary = summarize([r[3] for r in rows], wall_seconds)
+        summary["errors"] = sum(1 for r in rows if r[1] is None or r[1] >= 500)
+        outcomes = {}
+        for r in rows:
+            outcomes[str(r[2])] = outcomes.get(str(r[2]), 0) + 1
+        summary["outcomes"] = outcomes
+        report[endpoint] = summary
+    return report
+
+
+def stage_report(log_path, since):
+    """Per-stage latency from the server's JSON "stage" log lines written after `since`."""
+    stages = {}
+    with open(log_path, errors="replace") as f:
+        for line in f:
+            if not line.startswith('{"event": "stage"'):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("ts", 0) >= round(since, 3) - 0.001:  # log timestamps are rounded to ms
+                stages.setdefault(event["stage"], []).append(event["ms"] / 1000.0)
+    return {name: summarize(samples) for name, samples in sorted(stages.items())}
+
+
+def print_table(title, rows, columns):
+    print(f"\n{title}")
+    print(f"{'':<22}" + "".join(f"{c:>11}" for c in columns))
+    for name, summary in rows.items():
+        print(f"{name:<22}" + "".join(f"{str(summary.get(c, '-')):>11}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", required=True, help="directory with commands.jsonl and optional clips")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--repeat", type=int, default=10, help="times the corpus is replayed")
+    parser.add_argument("--warmup", type=int, default=5, help="requests sent before measuring")
+    parser.add_argument("--seed", type=int, default=1, help="shuffle seed, so runs are comparable")
+    parser.add_argument("--server", default="flask", choices=["flask", "gunicorn", "asgi"], help="how to start the server")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for gunicorn/asgi")
+    parser.add_argument("--port", type=int, default=5055, help="port for the started server")
+    parser.add_argument("--target", help="replay against this already running server instead")
+    parser.add_argument("--stub-port", type=int, default=0, help="port for the stubs (0 = any free port)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the started server, e.g. POLISH_MODE=fused (repeatable)")
+    parser.add_argument("--json", dest="json_out", help="write the full report to this file")
+    stubs.add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        latency, errors = stubs.stub_config(args)
+    except ValueError as e:
+        sys.exit(str(e))
+    commands = load_commands(args.corpus)
+    clips = load_corpus(args.corpus)
+    if not commands and not clips:
+        sys.exit(f"nothing to replay in {args.corpus}")
+
+    stub_server = stubs.make_server(port=args.stub_port, latency=latency, errors=errors, corpus=args.corpus)
+    threading.Thread(target=stub_server.serve_forever, name="stubs", daemon=True).start()
+    stub_url = f"http://127.0.0.1:{stub_server.server_address[1]}"
+    print(f"stubs on {stub_url}")
+
+    proc = log = workdir = None
+    base_url = (args.target or f"http://127.0.0.1:{args.port}").rstrip("/")
+    try:
+        if not args.target:
+            workdir = tempfile.mkdtemp(prefix="replay-")
+            extra_env = dict(e.split("=", 1) for e in args.env)
+            proc, log = start_server(args.server, args.port, args.workers, stub_url, workdir, extra_env)
+        wait_until_up(base_url, proc)
+
+        warmup = build_workload(commands, clips, 1, args.seed)[:args.warmup]
+        run_workload(base_url, warmup, args.concurrency)
+
+        measure_from = time.time()
+        work = build_workload(commands, clips, args.repeat, args.seed)
+        print(f"replaying {len(work)} requests at concurrency {args.concurrency} against {base_url}")
+        results, wall = run_workload(base_url, work, args.concurrency)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            log.close()
+        stub_server.shutdown()
+
+    report = {
+        "wall_seconds": round(wall, 3),
+        "endpoints": endpoint_report(results, wall),
+        "stages": stage_report(os.path.join(workdir, "server.log"), measure_from) if workdir else {},
+        "upstream_calls": stub_server.state.counts,
+    }
+    print_table(f"endpoints ({len(results)} requests in {wall:.1f}s)", report["endpoints"],
+                ["count", "errors", "req_per_s", "p50_ms", "p95_ms", "p99_ms"])
+    if report["stages"]:
+        print_table("stages", report["stages"], ["count", "p50_ms", "p95_ms", "p99_ms"])
+    print("\nupstream calls: " + ", ".join(f"{k}={v['calls']} ({v['injected_errors']} injected errors)"
+                                            for k, v in report["upstream_calls"].items()))
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Compares speech-to-text backends on a fixed clip corpus.
+
+The corpus is a directory of audio clips, each with a reference transcript in
+a .txt file of the same name (e.g. standup.webm + standup.txt). Every clip is
+transcribed by each backend and the script reports latency (p50/p95/mean)
+and word error rate per backend.
+
+    python bench/stt_benchmark.py --corpus bench/clips --backends remote,local --repeat 3
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("STT_WARMUP", "0")
+
+AUDIO_EXTENSIONS = {".webm", ".ogg", ".oga", ".wav", ".flac", ".mp3", ".m4a", ".mp4", ".mpeg", ".mpga"}
+
+
+def normalize_words(text):
+    text = re.sub(r"[^\w@.'\s]", " ", (text or "").lower())
+    return [w.strip(".") for w in text.split() if w.strip(".")]
+
+
+def word_edit_distance(ref, hyp):
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1]
+
+
+def load_corpus(path):
+    clips = []
+    for name in sorted(os.listdir(path)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in AUDIO_EXTENSIONS:
+            continue
+        ref_path = os.path.join(path, stem + ".txt")
+        if not os.path.exists(ref_path):
+            print(f"skipping {name}: no {stem}.txt reference")
+            continue
+        with open(os.path.join(path, name), "rb") as f:
+            audio = f.read()
+        with open(ref_path) as f:
+            reference = f.read().strip()
+        clips.append({"name": name, "audio": audio, "reference": reference})
+    return clips
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def run_backend(backend, clips, repeat):
+    latencies, edits, ref_words, failures, rows = [], 0, 0, 0, []
+    backend.warm_up()
+    for clip in clips:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            transcript, error = backend.transcribe(clip["audio"])
+            elapsed = time.perf_counter() - started
+            if error:
+                failures += 1
+                rows.append({"clip": clip["name"], "error": error[0].get("message")})
+                continue
+            latencies.append(elapsed)
+            ref = normalize_words(clip["reference"])
+            dist = word_edit_distance(ref, normalize_words(transcript))
+            edits += dist
+            ref_words += len(ref)
+            rows.append({"clip": clip["name"], "seconds": round(elapsed, 3), "wer": round(dist / max(1, len(ref)), 3), "transcript": transcript})
+    summary = {
+        "backend": backend.name,
+        "runs": len(latencies),
+        "failures": failures,
+        "p50_s": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p95_s": round(percentile(latencies, 0.95), 3) if latencies else None,
+        "mean_s": round(statistics.mean(latencies), 3) if latencies else None,
+        "wer": round(edits / ref_words, 4) if ref_words else None,
+    }
+    return summary, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", required=True, help="directory of clips with .txt references")
+    parser.add_argument("--backends", default="remote,local", help="comma-separated STT backends to compare")
+    parser.add_argument("--repeat", type=int, default=1, help="transcriptions per clip per backend")
+    parser.add_argument("--json", dest="json_out", help="write full per-clip results to this file")
+    args = parser.parse_args()
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+
+    if not os.environ.get("OPENAI_API_KEY"):
+        if "remote" in backends:
+            sys.exit("OPENAI_API_KEY is required for the remote backend")
+        # server.py builds an OpenAI client at import time; the local backend never uses it
+        os.environ["OPENAI_API_KEY"] = "unused"
+    import server
+
+    clips = load_corpus(args.corpus)
+    if not clips:
+        sys.exit(f"no clips with references found in {args.corpus}")
+
+    summaries, details = [], {}
+    for name in backends:
+        backend_cls = server.STT_BACKENDS.get(name)
+        if backend_cls is None:
+            sys.exit(f"unknown backend {name!r}; choose from {sorted(server.STT_BACKENDS)}")
+        summary, rows = run_backend(backend_cls(), clips, args.repeat)
+        summaries.append(summary)
+        details[name] = rows
+
+    print(f"\n{len(clips)} clip(s), repeat={args.repeat}")
+    print(f"{'backend':<10}{'runs':>6}{'fail':>6}{'p50 s':>9}{'p95 s':>9}{'mean s':>9}{'WER':>8}")
+    for s in summaries:
+        print(f"{s['backend']:<10}{s['runs']:>6}{s['failures']:>6}{str(s['p50_s']):>9}{str(s['p95_s']):>9}{str(s['mean_s']):>9}{str(s['wer']):>8}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"summary": summaries, "clips": details}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Local stand-ins for the OpenAI and Google APIs the server calls.
+
+One HTTP server answers:
+    POST /v1/chat/completions          intent extraction and polishing (stream=true supported)
+    POST /v1/audio/transcriptions      Whisper
+    POST /gmail/v1/users/me/drafts, /drafts/send, /messages/send, GET /drafts/<id>, GET /drafts (search)
+    POST /calendar/v3/calendars/primary/events, GET /events (list, syncToken), GET /events/<id>
+
+Each upstream (chat, whisper, gmail, calendar) gets a latency distribution
+and an error rate, e.g.
+
+    python bench/stubs.py --port 8090 --corpus bench/corpus \
+        --latency chat=450:1400 --latency whisper=900 --errors whisper=0.05:503
+
+--latency NAME=MEDIAN_MS[:P95_MS] draws from a log-normal with that median
+and 95th percentile (a fixed delay without P95). --errors NAME=RATE[:STATUS]
+answers that fraction of calls with STATUS (default 503). Point the server at
+it with OPENAI_BASE_URL=http://127.0.0.1:8090/v1 and
+GOOGLE_API_BASE_URL=http://127.0.0.1:8090.
+
+Answers come from the replay corpus: intents recorded in commands.jsonl are
+returned for the matching command text, and clips are transcribed to their
+.txt reference. Anything else gets a generic answer.
+"""
+import argparse
+import email.parser
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UPSTREAMS = ("chat", "whisper", "gmail", "calendar")
+COMMAND_RE = re.compile(r'COMMAND: """(.*?)"""', re.S)
+
+
+def parse_latency(spec):
+    """'450' -> fixed 450 ms; '450:1400' -> log-normal with median 450 ms, p95 1400 ms."""
+    median, _, p95 = spec.partition(":")
+    median = float(median) / 1000.0
+    if not p95:
+        return lambda: median
+    sigma = math.log(float(p95) / 1000.0 / median) / 1.645
+    return lambda: random.lognormvariate(math.log(median), sigma)
+
+
+def parse_errors(spec):
+    rate, _, status = spec.partition(":")
+    return float(rate), int(status or 503)
+
+
+def _named_specs(values, parse):
+    out = {}
+    for value in values or []:
+        name, _, spec = value.partition("=")
+        if name not in UPSTREAMS or not spec:
+            raise ValueError(f"expected one of {UPSTREAMS}=..., got {value!r}")
+        out[name] = parse(spec)
+    return out
+
+
+def load_answers(corpus_dir):
+    """Returns ({command text: intent}, {sha1 of clip: transcript}) from a replay corpus."""
+    intents, transcripts = {}, {}
+    if not corpus_dir:
+        return intents, transcripts
+    commands_path = os.path.join(corpus_dir, "commands.jsonl")
+    if os.path.exists(commands_path):
+        with open(commands_path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get("intent"):
+                        intents[entry["text"].strip().lower()] = entry["intent"]
+    for name in sorted(os.listdir(corpus_dir)):
+        stem, ext = os.path.splitext(name)
+        ref_path = os.path.join(corpus_dir, stem + ".txt")
+        if ext.lower() in (".txt", ".jsonl") or not os.path.exists(ref_path):
+            continue
+        with open(os.path.join(corpus_dir, name), "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        with open(ref_path) as f:
+            transcripts[digest] = f.read().strip()
+    return intents, transcripts
+
+
+def generic_intent(command):
+    start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    return {
+        "intent": "create_event", "recipients": [], "subject": None, "body": None,
+        "start_datetime": start.isoformat(), "end_datetime": (start + timedelta(minutes=30)).isoformat(),
+        "title": command[:60] or "Meeting", "timezone": None, "when": None, "clarify": [],
+    }
+
+
+class StubState:
+    def __init__(self, latency=None, errors=None, corpus=None):
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.intents, self.transcripts = load_answers(corpus)
+        self._fallback_transcripts = itertools.cycle(list(self.transcripts.values()) or ["schedule a meeting tomorrow at 10am"])
+        self._lock = threading.Lock()
+        self.counts = {name: {"calls": 0, "injected_errors": 0} for name in UPSTREAMS}
+        self._seen_prefixes = set()
+        self.events = []  # (change number, event) in insert order; sync tokens are change numbers
+
+    def delay_and_fault(self, upstream):
+        """Sleeps for the upstream's latency; returns an error status to inject, or None."""
+        sample = self.latency.get(upstream)
+        if sample is not None:
+            time.sleep(sample())
+        rate, status = self.errors.get(upstream, (0.0, 503))
+        failed = random.random() < rate
+        with self._lock:
+            self.counts[upstream]["calls"] += 1
+            if failed:
+                self.counts[upstream]["injected_errors"] += 1
+        return status if failed else None
+
+    def chat_usage(self, messages, content):
+        """Usage block at ~4 characters per token; a repeated system message of
+        1024+ tokens is reported as cached, in 128-token steps, as OpenAI does."""
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        system = (messages[0].get("content") or "") if messages[0].get("role") == "system" else ""
+        prefix_tokens = len(system) // 4
+        with self._lock:
+            seen = system in self._seen_prefixes
+            self._seen_prefixes.add(system)
+        cached = prefix_tokens // 128 * 128 if seen and prefix_tokens >= 1024 else 0
+        completion_tokens = len(content) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens, "prompt_tokens_details": {"cached_tokens": cached}}
+
+    def fallback_transcript(self):
+        with self._lock:
+            return next(self._fallback_transcripts)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # set by make_server()
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes; without this, Nagle's
+        # algorithm plus delayed ACKs add ~40 ms to every stubbed call
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status):
+        self._json({"error": {"code": status, "message": "injected by stub", "status": "UNAVAILABLE"}}, status)
+
+    def _upstream(self):
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/chat/completions"):
+            return "chat", path
+        if path.endswith("/audio/transcriptions"):
+            return "whisper", path
+        if path.startswith("/gmail/"):
+            return "gmail", path
+        if path.startswith("/calendar/"):
+            return "calendar", path
+        return None, path
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_HEAD(self):
+        # the Whisper warm-up opens a connection with HEAD
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _handle(self, method):
+        body = self._body()
+        upstream, path = self._upstream()
+        if upstream is None:
+            self._json({"error": {"message": f"no stub for {method} {path}"}}, 404)
+            return
+        status = self.state.delay_and_fault(upstream)
+        if status is not None:
+            self._error(status)
+            return
+        getattr(self, f"_{upstream}")(method, path, body)
+
+    # ----- OpenAI -----
+    def _chat(self, method, path, body):
+        request = json.loads(body or b"{}")
+        messages = request.get("messages") or [{}]
+        prompt = messages[-1].get("content") or ""
+        match = COMMAND_RE.search(prompt)
+        if match:
+            command = match.group(1).strip()
+            content = json.dumps(self.state.intents.get(command.lower()) or generic_intent(command))
+        else:
+            # polishing: hand the body back unchanged
+            content = prompt.split("\n\n", 1)[-1]
+        model = request.get("model", "stub")
+        usage = self.state.chat_usage(messages, content)
+        if request.get("stream"):
+            self._chat_stream(model, content, usage if (request.get("stream_options") or {}).get("include_usage") else None)
+            return
+        self._json({
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _chat_stream(self, model, content, usage=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for word in re.findall(r"\S+\s*", content):
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if usage is not None:
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _whisper(self, method, path, body):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + self.headers.get("Content-Type", "").encode() + b"\r\n\r\n" + body)
+        audio = b""
+        for part in message.walk():
+            if part.get_filename():
+                audio = part.get_payload(decode=True) or b""
+        transcript = self.state.transcripts.get(hashlib.sha1(audio).hexdigest())
+        self._json({"text": transcript or self.state.fallback_transcript()})
+
+    # ----- Google -----
+    def _gmail(self, method, path, body):
+        if method == "POST" and path.endswith("/drafts/send"):
+            self._json({"id": f"msg-{uuid.uuid4().hex[:12]}", "labelIds": ["SENT"]})
+        elif method == "POST" and path.endswith("/drafts"):
+            self._json({"id": f"r-{uuid.uuid4().hex[:12]}", "message": {"id": uuid.uuid4().hex[:12]}})
+        elif method == "POST" and path.endswith("/messages/send"):
+            self._json({"id": uuid.uuid4().hex[:12], "labelIds": ["SENT"]})
+        elif method == "GET" and path.endswith("/drafts"):
+            self._json({"resultSizeEstimate": 0})
+        elif method == "GET" and "/drafts/" in path:
+            self._json({"id": path.rsplit("/", 1)[-1], "message": {"payload": {"headers": [
+                {"name": "To", "value": "someone@example.com"}, {"name": "Subject", "value": "Stub"}]}}})
+        else:
+            self._json({"error": {"message": f"no gmail stub for {method} {path}"}}, 404)
+
+    def _calendar(self, method, path, body):
+        if path.endswith("/events") and method == "POST":
+            event = json.loads(body or b"{}")
+            event.setdefault("id", uuid.uuid4().hex)
+            event["htmlLink"] = f"https://calendar.example/event?eid={event['id']}"
+            with self.state._lock:
+                self.state.events.append((len(self.state.events) + 1, event))
+            self._json(event)
+        elif path.endswith("/events") and method == "GET":
+            query = urllib.parse.parse_qs(self.path.partition("?")[2])
+            since = int((query.get("syncToken") or ["0"])[0])
+            with self.state._lock:
+                items = [event for number, event in self.state.events if number > since]
+                latest = len(self.state.events)
+            self._json({"kind": "calendar#events", "timeZone": "UTC", "items": items, "nextSyncToken": str(latest)})
+        elif "/events/" in path and method == "GET":
+            event_id = path.rsplit("/", 1)[-1]
+            self._json({"id": event_id, "htmlLink": f"https://calendar.example/event?eid={event_id}"})
+        else:
+            self._json({"error": {"message": f"no calendar stub for {method} {path}"}}, 404)
+
+
+def make_server(host="127.0.0.1", port=0, latency=None, errors=None, corpus=None):
+    """Returns a ThreadingHTTPServer (not yet serving); its StubState is server.state."""
+    state = StubState(latency, errors, corpus)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def add_stub_arguments(parser):
+    parser.add_argument("--latency", action="append", metavar="NAME=MEDIAN_MS[:P95_MS]",
+                        help=f"upstream latency; NAME is one of {', '.join(UPSTREAMS)} (repeatable)")
+    parser.add_argument("--errors", action="append", metavar="NAME=RATE[:STATUS]",
+                        help="fraction of calls answered with STATUS, default 503 (repeatable)")
+
+
+def stub_config(args):
+    return _named_specs(args.latency, parse_latency), _named_specs(args.errors, parse_errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--corpus", help="replay corpus to answer from (commands.jsonl + clips)")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    try:
+        latency, errors = stub_config(args)
+    except ValueError as e:
+        sys.exit(str(e))
+    server = make_server(args.host, args.port, latency, errors, args.corpus)
+    print(f"stubs listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.state.counts, indent=2))
+
+
+if __name__ == "__main__":
+    main()
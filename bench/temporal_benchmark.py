@@ -0,0 +1,142 @@
+"""
+Checks the temporal resolver against a table of phrases and times it.
+
+Each line of the table (default bench/corpus/temporal.jsonl) is one case:
+
+    {"phrase": "next tuesday 3pm for 45 minutes", "timezone": "America/New_York",
+     "now": "2025-03-05T14:20:00-05:00", "resolves": true,
+     "start": "2025-03-11T15:00:00-04:00", "end": "2025-03-11T15:45:00-04:00"}
+
+"resolves": false means the resolver must give up so the model's datetimes are
+used. "start": null means the phrase names a day but no time. The cases pin
+"now", so they include DST changes, month and year rollovers and weekdays that
+fall on today.
+
+    python bench/temporal_benchmark.py
+    python bench/temporal_benchmark.py --repeat 2000 --json temporal.json
+
+Every case is checked, then each phrase is resolved --repeat times and the
+script reports per-call latency. It also times the push of a past start time
+to its next occurrence against the day-by-day loop it replaced. The exit
+status is 1 when any case fails.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+os.environ.setdefault("STT_WARMUP", "0")
+# server.py builds an OpenAI client at import time; nothing here calls it
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from stt_benchmark import percentile
+
+
+def load_cases(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_case(server, case):
+    """Returns None when the resolver agrees with the case, else a description of the difference."""
+    now = datetime.fromisoformat(case["now"])
+    res = server.resolve_time_phrase(case["phrase"], case["timezone"], now)
+    if not case["resolves"]:
+        return None if res is None else f"expected no resolution, got start={res.start and res.start.isoformat()}"
+    if res is None:
+        return "expected a resolution, got none"
+    got = (res.start and res.start.isoformat(), res.end and res.end.isoformat())
+    want = (case.get("start"), case.get("end"))
+    return None if got == want else f"expected {want}, got {got}"
+
+
+def time_calls(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def micro_summary(samples):
+    return {
+        "calls": len(samples),
+        "mean_us": round(statistics.mean(samples) * 1e6, 2),
+        "p50_us": round(percentile(samples, 0.50) * 1e6, 2),
+        "p95_us": round(percentile(samples, 0.95) * 1e6, 2),
+        "p99_us": round(percentile(samples, 0.99) * 1e6, 2),
+    }
+
+
+def day_by_day(start_dt, now, max_days=30, tolerance=timedelta(seconds=60)):
+    """The loop normalize_parsed_intent used before next_occurrence(), kept for comparison."""
+    days_moved = 0
+    new_start = start_dt
+    while new_start < (now - tolerance) and days_moved < max_days:
+        new_start = new_start + timedelta(days=1)
+        days_moved += 1
+    return new_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=os.path.join(BENCH_DIR, "corpus", "temporal.jsonl"), help="table of cases (JSON lines)")
+    parser.add_argument("--repeat", type=int, default=500, help="timed resolutions per phrase")
+    parser.add_argument("--json", dest="json_out", help="write the report to this file")
+    args = parser.parse_args()
+
+    import server
+
+    cases = load_cases(args.cases)
+    failures = []
+    for case in cases:
+        problem = check_case(server, case)
+        if problem:
+            failures.append({"phrase": case["phrase"], "timezone": case["timezone"], "now": case["now"], "problem": problem})
+
+    samples = []
+    for case in cases:
+        now = datetime.fromisoformat(case["now"])
+        samples.extend(time_calls(lambda: server.resolve_time_phrase(case["phrase"], case["timezone"], now), args.repeat))
+
+    tz = server.get_zone("America/New_York")
+    now = datetime(2025, 3, 5, 14, 20, tzinfo=tz)
+    push = {}
+    for days_back in (1, 7, 30):
+        start = now.replace(hour=9, minute=0) - timedelta(days=days_back)
+        push[f"{days_back}d"] = {
+            "day_by_day": micro_summary(time_calls(lambda: day_by_day(start, now), args.repeat)),
+            "next_occurrence": micro_summary(time_calls(lambda: server.next_occurrence(start, now), args.repeat)),
+        }
+
+    report = {
+        "cases": len(cases),
+        "passed": len(cases) - len(failures),
+        "failures": failures,
+        "resolve": micro_summary(samples),
+        "push_forward": push,
+    }
+    for failure in failures:
+        print(f"FAIL {failure['phrase']!r} ({failure['timezone']}, now {failure['now']}): {failure['problem']}")
+    print(f"\n{report['passed']}/{report['cases']} cases pass")
+    r = report["resolve"]
+    print(f"resolve_time_phrase: mean {r['mean_us']} us, p50 {r['p50_us']} us, p95 {r['p95_us']} us, p99 {r['p99_us']} us over {r['calls']} calls")
+    print(f"\n{'past start':<12}{'day-by-day p50 us':>20}{'next_occurrence p50 us':>26}")
+    for name, row in push.items():
+        print(f"{name:<12}{row['day_by_day']['p50_us']:>20}{row['next_occurrence']['p50_us']:>26}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()